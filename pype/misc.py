@@ -6,28 +6,114 @@ Copyright (C) 2017-2021 Nima Alamatsaz <nima.alamatsaz@gmail.com>
 '''
 
 import logging
+import operator
 import threading
-import collections
 import numpy       as     np
 
+try:
+    import numba
+except ImportError:
+    # optional, only used for accelerating 1-dimensional circular buffers
+    numba = None
+
 
 log = logging.getLogger(__name__)
 
 
 def listLike(obj, strIncluded=True):
-    return (hasattr(obj, '__len__') and
-        (strIncluded or not isinstance(obj, str)) )
+    if not strIncluded and isinstance(obj, str):
+        return False
+    return hasattr(obj, '__len__')
 
 def iterable(obj):
-    return isinstance(obj, collections.Iterable)
+    # avoid the (slower) virtual subclass check of `collections.abc.Iterable`
+    return hasattr(obj, '__iter__')
+
+def alignedZeros(shape, dtype=np.float64, alignment=64):
+    '''Allocate a zero-filled array starting at an `alignment` byte boundary.
+
+    Defaults to the cache line size of common CPUs. Arrays of references (e.g.
+    `object` dtype) cannot be reinterpreted from raw bytes and are allocated
+    without alignment.
+    '''
+    dtype  = np.dtype(dtype)
+    if dtype.hasobject or dtype.itemsize == 0:
+        return np.zeros(shape, dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw    = np.zeros(nbytes + alignment, np.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+def _raiseOverflow(nsRead, nsWritten, capacity):
+    '''Raise the error for a circular buffer overflow.'''
+    raise BufferError('Circular buffer overflow occured (%d, %d, %d)' %
+        (nsRead, nsWritten, capacity))
+
+def _raiseWriteIndex(at, nsWritten, nsRead):
+    '''Raise the error for writing to a circular buffer at an invalid index.'''
+    if at < 0:
+        raise IndexError('Cannot write before 0')
+    if nsWritten < at:
+        raise IndexError('Cannot skip and write (write: %d, at: %d)' %
+            (nsWritten, at))
+    raise IndexError('Cannot write before last read sample '
+        '(at: %d, nsWrite: %d, nsRead: %d)' % (at, nsWritten, nsRead))
+
+def _raiseReadIndex(frm, to, nsWritten, capacity):
+    '''Raise the error for reading an invalid range of a circular buffer.'''
+    if to < frm:
+        raise IndexError('Cannot read less negative number of samples')
+    if frm < nsWritten - capacity:
+        raise IndexError('Cannot read past (circular) buffer size')
+    raise IndexError('Cannot read past last written sample')
+
+
+def _jitSupported(dtype):
+    '''Whether the numba kernels below can handle buffers of `dtype`.'''
+    # no float16, long double or non-native byte order in numba
+    return (numba is not None and dtype.isnative and (dtype.kind in 'biu'
+        or dtype.kind == 'f' and dtype.itemsize in (4, 8)
+        or dtype.kind == 'c' and dtype.itemsize in (8, 16)))
+
+# for larger chunks the two contiguous slice copies of numpy are faster
+_jitMaxSamples = 1024
+
+if numba is not None:
+    @numba.njit(cache=True, boundscheck=False)
+    def _jitWrite1d(buf, mask, at, data):
+        '''Write `data` to a 1-dimensional circular `buf` starting at `at`.'''
+        for i in range(data.shape[0]):
+            buf[(at + i) & mask] = data[i]
+
+    @numba.njit(cache=True, boundscheck=False)
+    def _jitRead1d(buf, mask, frm, to, out):
+        '''Read samples `frm` to `to` of a 1-dimensional circular `buf`.'''
+        for i in range(to - frm):
+            out[i] = buf[(frm + i) & mask]
 
 
 class CircularBuffer():
-    '''An efficient circular buffer using numpy array.'''
+    '''An efficient circular buffer using numpy array.
+
+    The buffer is lock-free for a single producer and a single consumer: only
+    the producer (`write`) advances `nsWritten` and only the consumer (`read`)
+    advances `nsRead`. Both are plain monotonically increasing integers, which
+    is safe without atomics under CPython's GIL. The only exception is an
+    automatically handled overflow, which drops unread samples on write.
+
+    All counters and indices are kept as Python ints (arbitrary precision),
+    user supplied values are converted once on entry to avoid mixed arithmetic
+    with numpy scalars.
+    '''
 
     @property
     def shape(self):
-        return self._data.shape
+        return self._shape
+
+    @property
+    def capacity(self):
+        '''Number of samples the buffer can hold along the circular axis.'''
+        return self._capacity
 
     @property
     def axis(self):
@@ -52,10 +138,10 @@ class CircularBuffer():
         if self._nsWritten < value:
             raise IndexError('Cannot fast forward')
 
-        self._nsWritten = value
+        self._nsWritten = int(value)
         if value < self._nsRead:
-            self._nsRead = value
-        self._updatedEvent.set()
+            self._nsRead = int(value)
+        self._setUpdated()
 
     @property
     def nsRead(self):
@@ -75,11 +161,11 @@ class CircularBuffer():
             raise IndexError('Cannot rewind past 0')
         if self._nsRead < value:
             raise IndexError('Cannot fast forward')
-        if value < self._nsWritten - self._data.shape[self._axis]:
+        if value < self._nsWritten - self._capacity:
             raise IndexError('Cannot rewind past the (circular) buffer size')
 
-        self._nsRead = value
-        self._updatedEvent.set()
+        self._nsRead = int(value)
+        self._setUpdated()
 
     @property
     def nsAvailable(self):
@@ -87,6 +173,13 @@ class CircularBuffer():
         self._checkOverflow()
         return self._nsWritten - self._nsRead
 
+    def __new__(cls, shape, *args, **kwargs):
+        # specialize for 1-dimensional buffers, bypassing multi-dimensional
+        # windows altogether
+        if cls is CircularBuffer and (not listLike(shape) or len(shape) == 1):
+            cls = _CircularBuffer1d
+        return super().__new__(cls)
+
     def __init__(self, shape, axis=-1, dtype=np.float64, allowOverflow=False):
         '''
         Args:
@@ -99,13 +192,57 @@ class CircularBuffer():
                 raise an exception (False) or automatically handle buffer
                 overflow (True). Defaults to False.
         '''
-        self._data          = np.zeros(shape, dtype)
+        # same validation as numpy, the array itself is allocated padded
+        shape    = [operator.index(size) for size in
+            (shape if listLike(shape) else [shape])]
+        if any(size < 0 for size in shape):
+            raise ValueError('Negative dimensions are not allowed')
+        if not -len(shape) <= axis < len(shape):
+            raise IndexError('`axis` is out of bounds for %d dimensions' %
+                len(shape))
+        # resolve once instead of on every indexing
+        axis     = axis % len(shape)
+        capacity = shape[axis]
+        self._shape = tuple(shape)
+        # shape of the non-circular dimensions for validating written data
+        shapeOther = list(shape)
+        del shapeOther[axis]
+        self._shapeOther = tuple(shapeOther)
+
+        # pad the circular axis to a power of two, so that wrapping absolute
+        # indices only takes a bitwise and instead of a modulo
+        shape[axis] = 1 << max(capacity - 1, 0).bit_length()
+        # when circular along the last dimension, keep each row aligned to the
+        # cache line (still a power of two for all regular item sizes)
+        itemsize = np.dtype(dtype).itemsize
+        if axis == len(shape) - 1 and itemsize and 64 % itemsize == 0:
+            shape[axis] = max(shape[axis], 64 // itemsize)
+
+        self._data          = alignedZeros(shape, dtype)
         self._axis          = axis
+        self._capacity      = capacity
+        # padded length of the underlying array along the circular axis
+        self._length        = shape[axis]
+        self._mask          = shape[axis] - 1
+        # full slices before and after the circular axis for building windows
+        self._windowPre     = (slice(None),) * axis
+        self._windowPost    = (slice(None),) * (len(shape) - axis - 1)
+        self._jit           = (self._data.ndim == 1 and
+            _jitSupported(self._data.dtype))
         self._allowOverflow = allowOverflow
         self._nsWritten     = 0
         self._nsRead        = 0
-        self._updatedEvent  = threading.Event()
-        self._lock          = threading.Lock()
+        self._updated       = False
+        # only used when the consumer has to block in `wait`
+        self._waiting       = False
+        self._cond          = threading.Condition()
+        self._scratch       = None
+
+        # compile (or load from cache) the kernels for this dtype here instead
+        # of on the first write/read, possibly in a streaming thread
+        if self._jit:
+            _jitWrite1d(self._data, self._mask, 0, self._data[:0])
+            _jitRead1d(self._data, self._mask, 0, 0, self._data[:0])
 
     def __str__(self):
         return ' nsWritten: %d\nData:\n%s' % (self._nsWritten, self._data)
@@ -115,34 +252,78 @@ class CircularBuffer():
     #     return self._nsWritten
 
     def __enter__(self):
-        self._lock.acquire()
+        # no locking needed, kept for backward compatibility
+        return self
 
     def __exit__(self, *args):
-        self._lock.release()
+        pass
 
-    def _getWindow(self, indices):
-        '''Get a multi-dimensional and circular window into the buffer.
+    def _getWindow(self, s):
+        '''Get a multi-dimensional window into the buffer.
 
         Args:
-            indices (array-like): 1-dimensional array with absolute indices
-                (i.e. relative to the first sample) along the circular axis of
-                the buffer.
+            s (slice): Slice along the circular axis of the buffer.
         '''
-        indices %= self._data.shape[self._axis]
-        window = [slice(None)]*self._data.ndim
-        window[self._axis] = indices
-        return tuple(window)
+        return self._windowPre + (s,) + self._windowPost
+
+    def _wrap(self, at, n):
+        '''Locate `n` samples in the circular axis of the buffer.
+
+        The range wraps around at most once, so only the start needs wrapping.
+
+        Args:
+            at (int): Absolute index (i.e. relative to the first sample) of the
+                first sample.
+            n (int): Number of samples, at most the length of the underlying
+                array along the circular axis.
+
+        Returns:
+            tuple of int: Start index in the buffer and number of samples before
+                wrapping around, i.e. the samples are at `start:start+split`
+                followed by `0:n-split`.
+        '''
+        start = at & self._mask
+        return start, min(n, self._length - start)
 
     def _checkOverflow(self):
         '''Check for buffer overflow.'''
-        if self._nsRead < self._nsWritten - self._data.shape[self._axis]:
+        if self._nsRead < self._nsWritten - self._capacity:
             if self._allowOverflow:
-                self._nsRead = self._nsWritten - self._data.shape[self._axis]
+                self._nsRead = self._nsWritten - self._capacity
             else:
-                raise BufferError(
-                    'Circular buffer overflow occured (%d, %d, %d)' %
-                    (self._nsRead, self._nsWritten,
-                    self._data.shape[self._axis]))
+                _raiseOverflow(self._nsRead, self._nsWritten, self._capacity)
+
+    def _getAt(self, at, nsWritten, nsRead):
+        '''Resolve and verify the absolute index for writing.'''
+
+        if at is None:
+            at = nsWritten
+        else:
+            at = int(at)
+            if at < 0:
+                # TODO: shouldn't this be '+ at'?
+                at = nsWritten - at
+
+        # single check on the happy path, find the actual error otherwise
+        if not nsRead <= at <= nsWritten:
+            _raiseWriteIndex(at, nsWritten, nsRead)
+
+        return at
+
+    def _setUpdated(self):
+        '''Flag the buffer as updated and wake up the consumer if waiting.'''
+        self._updated = True
+        # `wait` sets `_waiting` before checking `_updated`, so either it sees
+        # the flag or the condition is notified here
+        if self._waiting:
+            with self._cond:
+                self._cond.notify()
+
+    def _advanceWritten(self, nsWritten):
+        '''Update written number of samples after writing to the buffer.'''
+        self._nsWritten = nsWritten
+        self._checkOverflow()
+        self._setUpdated()
 
     def write(self, data, at=None):
         '''Write samples to the end of buffer.
@@ -153,40 +334,79 @@ class CircularBuffer():
             at (int): ...
         '''
 
-        # convert to numpy array
-        if isinstance(data, list): data = np.array(data)
+        # convert to numpy array, no-op for arrays of the same dtype
+        data = np.asarray(data, dtype=self._data.dtype)
+        if data.ndim != self._data.ndim:
+            raise ValueError('`data` should have %d dimensions' %
+                self._data.ndim)
+        shape = list(data.shape)
+        n = shape.pop(self._axis)
+        if tuple(shape) != self._shapeOther:
+            raise ValueError('Shape of `data` %s does not match the buffer %s '
+                'except along the circular axis' % (data.shape, self._shape))
 
-        if at is None:
-            at = self._nsWritten
-        if at < 0:
-            # TODO: shouldn't this be '+ at'?
-            at = self._nsWritten - at
-        if at < 0:
-            raise IndexError('Cannot write before 0')
-        if self._nsWritten < at:
-            raise IndexError('Cannot skip and write (write: %d, at: %d)' %
-                (self._nsWritten, at))
-        if at < self._nsRead:
-            raise IndexError('Cannot write before last read sample ('
-                'at: %d, nsWrite: %d, nsRead: %d)' %
-                (at, self._nsWritten, self._nsRead) )
-
-        # prepare circular write indices
-        indices = np.arange(at, at + data.shape[self._axis])
-        window = self._getWindow(indices)
-        # write data to buffer
-        self._data[window] = data
-        # update written number of sample
-        self._nsWritten = at + data.shape[self._axis]
-        # check for buffer overflow
-        self._checkOverflow()
-        self._updatedEvent.set()
+        nsWritten = self._nsWritten
+        nsRead    = self._nsRead
+        at = self._getAt(at, nsWritten, nsRead)
+
+        # samples beyond the length of the buffer would be overwritten anyway
+        skip = max(n - self._length, 0)
+        start, split = self._wrap(at + skip, n - skip)
+        # write data to buffer in (at most) two contiguous segments, dtype
+        # already matches so no casting is needed
+        np.copyto(self._data[self._getWindow(slice(start, start + split))],
+            data[self._getWindow(slice(skip, skip + split))], casting='no')
+        if skip + split < n:
+            np.copyto(self._data[self._getWindow(slice(0, n - skip - split))],
+                data[self._getWindow(slice(skip + split, n))], casting='no')
 
-    def read(self, frm=None, to=None, advance=True):
+        self._advanceWritten(at + n)
+
+    def _getRange(self, frm, to):
+        '''Resolve and verify an absolute range of samples for reading.'''
+
+        # get value here to avoid racing condition
+        nsWritten = self._nsWritten
+        frm = self._nsRead if frm is None else int(frm)
+        to  = nsWritten    if to  is None else int(to)
+        if to < 0: to = nsWritten - to
+
+        # single check on the happy path, find the actual error otherwise
+        if not nsWritten - self._capacity <= frm <= to <= nsWritten:
+            _raiseReadIndex(frm, to, nsWritten, self._capacity)
+
+        return frm, to
+
+    def _copySegments(self, frm, to, start, split, out):
+        '''Copy samples `frm` to `to` into `out`, located by `_wrap`.'''
+        n = to - frm
+        if split == n:
+            np.copyto(out,
+                self._data[self._getWindow(slice(start, start + split))])
+            return
+        np.copyto(out[self._getWindow(slice(0, split))],
+            self._data[self._getWindow(slice(start, start + split))])
+        np.copyto(out[self._getWindow(slice(split, n))],
+            self._data[self._getWindow(slice(0, n - split))])
+
+    def _getScratch(self, n):
+        '''Get `n` samples of the scratch array, reused between calls.'''
+        if self._scratch is None or self._scratch.shape[self._axis] < n:
+            shape = list(self._data.shape)
+            shape[self._axis] = n
+            self._scratch = np.empty(shape, self._data.dtype)
+        return self._scratch[self._getWindow(slice(0, n))]
+
+    def read(self, frm=None, to=None, advance=True, copy=True):
         '''Read samples from the buffer.
 
-        Read data might have to be copied for thread safety and in order to
-        prevent being overwritten before being processed.
+        By default the read samples are copied into a new array. Otherwise, when
+        the requested range is contiguous in the buffer, the returned array is a
+        view into the buffer, or else a view into a scratch array reused between
+        calls, which is overwritten by the next wrapped around `read` or
+        `peekWindow`. Such views might have to be copied for thread safety and
+        in order to prevent being overwritten before being processed. Use
+        `readInto` for reading into a preallocated array instead.
 
         Args:
             frm (int): Start index for reading data. Defaults to None which
@@ -194,40 +414,176 @@ class CircularBuffer():
             to (int): End index for reading data. Negative values indicate an
                 end index relative to 'nsWritten' (last sample written).
                 Defaults to None which reads up to last available sample.
+            advance (bool): Advance `nsRead` to `to`. Defaults to True.
+            copy (bool): Return a new array (True) or avoid copying whenever
+                possible (False). Defaults to True.
         '''
 
-        # get value here to avoid racing condition
-        nsWritten = self._nsWritten
-        if frm is None: frm = self._nsRead
-        if to  is None: to  = nsWritten
-        if to < 0: to = nsWritten - to
-
-        if to < frm:
-            raise IndexError('Cannot read less negative number of samples')
-        if frm < self._nsWritten - self._data.shape[self._axis]:
-            raise IndexError('Cannot read past (circular) buffer size')
-        if nsWritten < to:
-            raise IndexError('Cannot read past last written sample')
-
-        indices = np.arange(frm, to)
+        frm, to = self._getRange(frm, to)
+        n = to - frm
 
         # without any locks there is still a chance for racing condition leading
         # to buffer overflow when new data is written after the boundary check
         # and before the returned data (by reference) is used
-        window = self._getWindow(indices)
+        start, split = self._wrap(frm, n)
+
+        if copy:
+            shape = list(self._data.shape)
+            shape[self._axis] = n
+            out = np.empty(shape, self._data.dtype)
+        elif split == n:
+            # advance number of samples read
+            if advance:
+                self._nsRead = to
+            return self._data[self._getWindow(slice(start, start + split))]
+        else:
+            # wrapped around, copy both segments into the scratch array
+            out = self._getScratch(n)
+
+        self._copySegments(frm, to, start, split, out)
+
+        # advance only after copying, so the producer cannot overwrite samples
+        # that are being copied
+        if advance:
+            self._nsRead = to
+
+        return out
+
+    def readInto(self, out, frm=None, to=None, advance=True):
+        '''Read samples from the buffer into a preallocated array.
+
+        Args:
+            out (numpy.ndarray): Destination array, its shape should match the
+                buffer's shape except for the number of samples along the
+                circular `axis`.
+            frm (int): Start index, same as in `read`.
+            to (int): End index, same as in `read`.
+            advance (bool): Advance `nsRead`, same as in `read`.
+
+        Returns:
+            numpy.ndarray: The given `out` array.
+        '''
+
+        frm, to = self._getRange(frm, to)
+        n = to - frm
+
+        shape = list(self._data.shape)
+        shape[self._axis] = n
+        if out.shape != tuple(shape):
+            raise ValueError('Shape of `out` %s should be %s' %
+                (out.shape, tuple(shape)))
+
+        start, split = self._wrap(frm, n)
+        self._copySegments(frm, to, start, split, out)
 
-        # advance number of samples read
         if advance:
             self._nsRead = to
 
-        # data should be copied after returning for thread safety
-        return self._data[window]
+        return out
+
+    def peekWindow(self, window, step=1, frm=None, to=None):
+        '''Get sliding windows over samples without advancing `nsRead`.
+
+        Windows are stacked along the circular axis and the samples of each
+        window occupy a new last dimension, same as
+        `numpy.lib.stride_tricks.sliding_window_view`. The returned array is a
+        read-only view into the buffer, or into a scratch array when the range
+        wraps around, which is overwritten by the next wrapped around peek.
+
+        Args:
+            window (int): Number of samples in each window.
+            step (int): Number of samples between the start of consecutive
+                windows. Defaults to 1.
+            frm (int): Start index, same as in `read`.
+            to (int): End index, same as in `read`.
+        '''
+
+        frm, to = self._getRange(frm, to)
+        n = to - frm
+
+        start, split = self._wrap(frm, n)
+        if split == n:
+            data = self._data[self._getWindow(slice(start, start + split))]
+        else:
+            data = self._getScratch(n)
+            self._copySegments(frm, to, start, split, data)
+
+        windows = np.lib.stride_tricks.sliding_window_view(data, window,
+            axis=self._axis)
+        return windows[self._getWindow(slice(None, None, step))]
 
     def wait(self):
-        self._updatedEvent.wait()
-        self._updatedEvent.clear()
+        '''Block until the buffer is updated since the last `wait`/`updated`.'''
+        with self._cond:
+            self._waiting = True
+            while not self._updated:
+                self._cond.wait()
+            self._waiting = False
+            self._updated = False
 
     def updated(self):
-        result = self._updatedEvent.isSet()
-        if result: self._updatedEvent.clear()
-        return result
+        '''Whether the buffer is updated since the last `wait`/`updated`.'''
+        # only clear when set, to not lose an update in between
+        if self._updated:
+            self._updated = False
+            return True
+        return False
+
+
+class _CircularBuffer1d(CircularBuffer):
+    '''Specialization of `CircularBuffer` for 1-dimensional buffers.'''
+
+    def write(self, data, at=None):
+        data = np.asarray(data, dtype=self._data.dtype)
+        if data.ndim != 1:
+            raise ValueError('`data` should have 1 dimensions')
+        n = data.shape[0]
+
+        nsWritten = self._nsWritten
+        nsRead    = self._nsRead
+        at = self._getAt(at, nsWritten, nsRead)
+
+        # only the layout compiled in `__init__` to avoid compiling again
+        if (self._jit and n <= _jitMaxSamples and data.flags.c_contiguous
+                and data.flags.writeable):
+            _jitWrite1d(self._data, self._mask, at, data)
+        else:
+            skip = max(n - self._length, 0)
+            start, split = self._wrap(at + skip, n - skip)
+            self._data[start:start + split] = data[skip:skip + split]
+            if skip + split < n:
+                self._data[:n - skip - split] = data[skip + split:]
+
+        self._advanceWritten(at + n)
+
+    write.__doc__ = CircularBuffer.write.__doc__
+
+    def read(self, frm=None, to=None, advance=True, copy=True):
+        frm, to = self._getRange(frm, to)
+        n = to - frm
+
+        start, split = self._wrap(frm, n)
+
+        if copy:
+            out = np.empty(n, self._data.dtype)
+        elif split == n:
+            if advance:
+                self._nsRead = to
+            return self._data[start:start + n]
+        else:
+            out = self._getScratch(n)
+
+        if split == n:
+            out[:] = self._data[start:start + n]
+        elif self._jit and n <= _jitMaxSamples:
+            _jitRead1d(self._data, self._mask, frm, to, out)
+        else:
+            out[:split] = self._data[start:]
+            out[split:] = self._data[:n - split]
+
+        if advance:
+            self._nsRead = to
+
+        return out
+
+    read.__doc__ = CircularBuffer.read.__doc__
@@ -11,7 +11,7 @@ setup(
     url='https://github.com/nalamat/pype',
     py_modules=['pype'],
     install_requires=[
-        'numpy',
+        'numpy>=1.20',
         'scipy',
         ],
     )